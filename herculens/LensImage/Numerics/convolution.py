@@ -7,9 +7,14 @@
 __author__ = 'sibirrer', 'austinpeel', 'aymgal'
 
 
+from functools import partial
 import numpy as np
+import jax
 import jax.numpy as jnp
+from jax import jit, lax
 from jax.scipy import signal
+from scipy import signal as scipy_signal
+from scipy.fft import next_fast_len
 from herculens.Util.jax_util import GaussianFilter
 from herculens.Util import util, kernel_util, image_util
 
@@ -21,14 +26,26 @@ class PixelKernelConvolution(object):
     """
     class to compute convolutions for a given pixelized kernel (fft, grid)
     """
-    def __init__(self, kernel):
+    def __init__(self, kernel, convolution_type='auto', dtype=None):
         """
 
         :param kernel: 2d array, convolution kernel
-        :param convolution_type: string, 'fft', 'grid', 'fft_static' mode of 2d convolution
+        :param convolution_type: string, 'fft', 'grid', 'fft_static' mode of 2d convolution, 
+        or 'auto' to choose between 'grid' and 'fft_static' based on the image and kernel sizes
+        :param dtype: if not None (e.g. jnp.bfloat16), the image and kernel are cast to this lower precision 
+        type and the direct convolution is always used, accumulated in float32. 
+        Not compatible with the Fourier-based convolution types ('fft', 'fft_static').
         """
-        self._kernel = kernel
+        self._kernel = jnp.asarray(kernel)
+        self._dtype = dtype
+        if convolution_type not in ['fft', 'grid', 'fft_static', 'auto']:
+            raise ValueError('convolution_type %s not supported!' % convolution_type)
+        if dtype is not None and convolution_type in ['fft', 'fft_static']:
+            raise ValueError('convolution_type %s does not support reduced precision (dtype=%s), '
+                             'use the direct convolution instead.' % (convolution_type, jnp.dtype(dtype)))
         self._type = convolution_type
+        self._kernel_fft_cache = {}
+        self._use_fft_cache = {}
 
     def pixel_kernel(self, num_pix=None):
         """
@@ -41,15 +58,116 @@ class PixelKernelConvolution(object):
             return kernel_util.cut_psf(self._kernel, num_pix)
         return self._kernel
 
+    def to_device(self, device=None):
+        """
+        places the kernel (and its cached Fourier transforms) on a given device.
+        This should be called before the first (jit-compiled) convolution.
+
+        :param device: jax.Device instance, if None uses the default device
+        """
+        self._kernel = jax.device_put(self._kernel, device)
+        for image_shape, (kernel_fft, fft_shape) in self._kernel_fft_cache.items():
+            self._kernel_fft_cache[image_shape] = (jax.device_put(kernel_fft, device), fft_shape)
+
+    @partial(jit, static_argnums=(0,))
     def convolution2d(self, image):
         """
 
         :param image: 2d array (image) to be convolved
         :return: fft convolution
         """
-        image_conv = signal.convolve2d(image, self._kernel, mode='same')
+        if self._dtype is not None:
+            image_conv = self._direct_convolution(image)
+        elif self._type == 'fft_static' or (self._type == 'auto' and self._use_fft(image.shape)):
+            image_conv = self._static_fft_convolution(image)
+        elif self._type == 'fft':
+            image_conv = signal.fftconvolve(image, self._kernel, mode='same')
+        else:
+            image_conv = self._direct_convolution(image)
         return image_conv
 
+    def _direct_convolution(self, image):
+        """
+        direct convolution using the XLA convolution primitive, equivalent to
+        signal.convolve2d(image, kernel, mode='same')
+
+        :param image: 2d array (image) to be convolved
+        :return: convolved image, with same shape as the input image
+        """
+        kx, ky = self._kernel.shape
+        padding = [(kx // 2, (kx - 1) // 2), (ky // 2, (ky - 1) // 2)]
+        # flip the kernel as lax.conv_general_dilated computes a cross-correlation
+        kernel = self._kernel[::-1, ::-1]
+        if self._dtype is None:
+            image_conv = lax.conv_general_dilated(image[None, None, :, :], kernel[None, None, :, :], 
+                                                  window_strides=(1, 1), padding=padding)
+        else:
+            image_conv = lax.conv_general_dilated(image.astype(self._dtype)[None, None, :, :], 
+                                                  kernel.astype(self._dtype)[None, None, :, :], 
+                                                  window_strides=(1, 1), padding=padding,
+                                                  precision=lax.Precision.HIGHEST,
+                                                  preferred_element_type=jnp.float32)
+            image_conv = image_conv.astype(image.dtype)
+        return image_conv[0, 0]
+
+    def _use_fft(self, image_shape):
+        """
+        estimates whether the fft convolution is cheaper than the direct one, 
+        computed at the first call for a given image shape.
+
+        :param image_shape: tuple, shape of the image to be convolved
+        :return: bool, True if the fft convolution should be used
+        """
+        image_shape = tuple(image_shape)
+        if image_shape not in self._use_fft_cache:
+            nx, ny = image_shape
+            kx, ky = np.shape(self._kernel)
+            cost_direct = nx * ny * kx * ky
+            fft_size = np.prod(self._fft_shape(image_shape))
+            cost_fft = 3 * fft_size * np.log2(fft_size)
+            self._use_fft_cache[image_shape] = bool(cost_fft < cost_direct)
+        return self._use_fft_cache[image_shape]
+
+    def _fft_shape(self, image_shape):
+        """
+        shape of the fft needed for the full convolution, using fast (not necessarily power of 2) sizes
+
+        :param image_shape: tuple, shape of the image to be convolved
+        :return: tuple, shape of the fft
+        """
+        return tuple(next_fast_len(n + k - 1, real=True) for n, k in zip(image_shape, np.shape(self._kernel)))
+
+    def _static_fft_convolution(self, image):
+        """
+        fft convolution with a kernel whose Fourier transform is computed only once per image shape
+
+        :param image: 2d array (image) to be convolved
+        :return: convolved image, with same shape as the input image
+        """
+        kernel_fft, fft_shape = self._static_kernel_fft(image.shape)
+        image_conv = jnp.fft.irfft2(jnp.fft.rfft2(image, s=fft_shape) * kernel_fft, s=fft_shape)
+        # select the central part, same as the 'same' mode of scipy.signal.convolve2d
+        nx, ny = image.shape
+        kx, ky = self._kernel.shape
+        start_x, start_y = (kx - 1) // 2, (ky - 1) // 2
+        return image_conv[start_x:start_x+nx, start_y:start_y+ny]
+
+    def _static_kernel_fft(self, image_shape):
+        """
+        Fourier transform of the kernel padded to the size of the full convolution,
+        computed (with numpy, as the kernel is fixed) at the first call for a given image shape.
+
+        :param image_shape: tuple, shape of the image to be convolved
+        :return: kernel Fourier transform, shape of the fft
+        """
+        image_shape = tuple(image_shape)
+        if image_shape not in self._kernel_fft_cache:
+            kernel = np.asarray(self._kernel)
+            fft_shape = self._fft_shape(image_shape)
+            kernel_fft = jnp.asarray(np.fft.rfft2(kernel, s=fft_shape))
+            self._kernel_fft_cache[image_shape] = (kernel_fft, fft_shape)
+        return self._kernel_fft_cache[image_shape]
+
     def re_size_convolve(self, image_low_res, image_high_res=None):
         """
 
@@ -75,25 +193,34 @@ class SubgridKernelConvolution(object):
         self._supersampling_factor = supersampling_factor
         numPix = int(n_high / self._supersampling_factor)
         if supersampling_kernel_size is None:
-            kernel_low_res, kernel_high_res = np.zeros((3, 3)), kernel_supersampled
-            self._low_res_convolution = False
+            kernel_high_res = kernel_supersampled
+            self._low_res_conv = None
         else:
             kernel_low_res, kernel_high_res = kernel_util.split_kernel(kernel_supersampled, supersampling_kernel_size,
                                                                        self._supersampling_factor)
-            self._low_res_convolution = True
-        self._low_res_conv = PixelKernelConvolution(kernel_low_res, convolution_type=convolution_type)
-        self._high_res_conv = PixelKernelConvolution(kernel_high_res, convolution_type=convolution_type)
+            self._low_res_conv = PixelKernelConvolution(kernel_low_res, convolution_type=convolution_type)
+        self._high_res_kernel, self._high_res_padding = self._binned_kernel(kernel_high_res, self._supersampling_factor)
 
+    def to_device(self, device=None):
+        """
+        places the kernels on a given device.
+        This should be called before the first (jit-compiled) convolution.
+
+        :param device: jax.Device instance, if None uses the default device
+        """
+        if self._low_res_conv is not None:
+            self._low_res_conv.to_device(device)
+        self._high_res_kernel = jax.device_put(self._high_res_kernel, device)
+
+    @partial(jit, static_argnums=(0,))
     def convolution2d(self, image):
         """
 
         :param image: 2d array (high resoluton image) to be convolved and re-sized
         :return: convolved image
         """
-
-        image_high_res_conv = self._high_res_conv.convolution2d(image)
-        image_resized_conv = image_util.re_size(image_high_res_conv, self._supersampling_factor)
-        if self._low_res_convolution is True:
+        image_resized_conv = self._high_res_convolution_re_size(image)
+        if self._low_res_conv is not None:
             image_resized = image_util.re_size(image, self._supersampling_factor)
             image_resized_conv += self._low_res_conv.convolution2d(image_resized)
         return image_resized_conv
@@ -104,12 +231,42 @@ class SubgridKernelConvolution(object):
         :param image_high_res: supersampled image/model to be convolved on a regular pixel grid
         :return: convolved and re-sized image
         """
-        image_high_res_conv = self._high_res_conv.convolution2d(image_high_res)
-        image_resized_conv = image_util.re_size(image_high_res_conv, self._supersampling_factor)
-        if self._low_res_convolution is True:
+        image_resized_conv = self._high_res_convolution_re_size(image_high_res)
+        if self._low_res_conv is not None:
             image_resized_conv += self._low_res_conv.convolution2d(image_low_res)
         return image_resized_conv
 
+    def _high_res_convolution_re_size(self, image_high_res):
+        """
+        convolution with the supersampled kernel and re-sizing to the regular grid in a single strided convolution,
+        equivalent to image_util.re_size(signal.convolve2d(image_high_res, kernel_high_res, mode='same'), factor)
+
+        :param image_high_res: 2d array (high resolution image) to be convolved and re-sized
+        :return: convolved image on the regular grid
+        """
+        factor = self._supersampling_factor
+        image_conv = lax.conv_general_dilated(image_high_res[None, None, :, :], 
+                                              self._high_res_kernel[None, None, :, :], 
+                                              window_strides=(factor, factor), 
+                                              padding=self._high_res_padding)
+        return image_conv[0, 0]
+
+    @staticmethod
+    def _binned_kernel(kernel, factor):
+        """
+        folds the averaging over factor x factor sub-pixels into the kernel, 
+        such that convolving and re-sizing reduces to a strided (cross-correlation) convolution
+
+        :param kernel: 2d array, supersampled kernel
+        :param factor: supersampling factor
+        :return: flipped binned kernel, padding of the image for each axis
+        """
+        kernel = np.asarray(kernel)
+        kernel_binned = scipy_signal.convolve2d(kernel, np.ones((factor, factor)) / factor**2, mode='full')
+        # same offsets as for the 'same' mode of scipy.signal.convolve2d
+        padding = [(k // 2, (k - 1) // 2) for k in kernel.shape]
+        return jnp.asarray(kernel_binned[::-1, ::-1]), padding
+
 
 class GaussianConvolution(object):
     """
@@ -117,7 +274,17 @@ class GaussianConvolution(object):
     """
 
     def __init__(self, sigma, pixel_scale, supersampling_factor=1, 
-                 supersampling_convolution=False, truncation=2):
+                 supersampling_convolution=False, truncation=2, dtype=None):
+        """
+
+        :param sigma: standard deviation of the Gaussian, in angular units
+        :param pixel_scale: pixel size, in angular units
+        :param supersampling_factor: supersampling factor relative to the image pixel grid
+        :param supersampling_convolution: bool, if True, performs the convolution on the supersampled grid
+        :param truncation: truncation of the Gaussian kernel, in units of sigma
+        :param dtype: if not None (e.g. jnp.bfloat16), the convolution is performed in this lower precision type, 
+        with float32 accumulation
+        """
         self._sigma = sigma / pixel_scale
         if supersampling_convolution is True:
             self._sigma *= supersampling_factor
@@ -125,7 +292,7 @@ class GaussianConvolution(object):
         self._pixel_scale = pixel_scale
         self._supersampling_factor = supersampling_factor
         self._supersampling_convolution = supersampling_convolution
-        self._gaussian_filter = GaussianFilter(self._sigma, self._truncation)
+        self._gaussian_filter = GaussianFilter(self._sigma, self._truncation, dtype=dtype)
 
     def convolution2d(self, image):
         """
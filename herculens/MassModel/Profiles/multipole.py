@@ -7,15 +7,34 @@
 __author__ = 'sibirrer', 'lynevdv', 'austinpeel', 'aymgal'
 
 
+from functools import partial
 import numpy as np
+import jax
 import jax.numpy as jnp
+from jax import jit
 
-import herculens.Util.param_util as param_util
+from herculens.Util.jax_util import pixel_map
 
 
 __all__ = ['Multipole']
 
 
+# closed forms of cos(m*phi) = T_m(cos(phi)) and sin(m*phi) = sin(phi) * U_{m-1}(cos(phi)) 
+# (Chebyshev polynomials of the first and second kinds) for the most common orders
+_CHEBYSHEV_TU = {
+    2: (lambda c: 2*c**2 - 1, 
+        lambda c: 2*c),
+    3: (lambda c: c * (4*c**2 - 3), 
+        lambda c: 4*c**2 - 1),
+    4: (lambda c: 8*c**4 - 8*c**2 + 1, 
+        lambda c: c * (8*c**2 - 4)),
+    5: (lambda c: c * (16*c**4 - 20*c**2 + 5), 
+        lambda c: 16*c**4 - 12*c**2 + 1),
+    6: (lambda c: 32*c**6 - 48*c**4 + 18*c**2 - 1, 
+        lambda c: c * (32*c**4 - 32*c**2 + 6)),
+}
+
+
 class Multipole(object):
     """
     This class contains a multipole contribution (for 1 component with m>=2)
@@ -41,8 +60,9 @@ class Multipole(object):
         :param center_y: x-position
         :return: lensing potential
         """
-        r, phi = param_util.cart2polar(x, y, center_x=center_x, center_y=center_y)
-        f_ = r*a_m /(1-m**2) * jnp.cos(m*(phi-phi_m))
+        r, cos_phi, sin_phi = self._polar_trig(x, y, center_x, center_y)
+        cos_m_phi, _ = self._angular_terms(m, phi_m, cos_phi, sin_phi)
+        f_ = r*a_m /(1-m**2) * cos_m_phi
         return f_
 
     def derivatives(self,x,y, m, a_m, phi_m, center_x=0, center_y=0):
@@ -57,11 +77,37 @@ class Multipole(object):
         :param center_y: x-position
         :return: deflection angles alpha_x, alpha_y
         """
-        r, phi = param_util.cart2polar(x, y, center_x=center_x, center_y=center_y)
-        f_x = jnp.cos(phi)*a_m/(1-m**2) * jnp.cos(m*(phi-phi_m)) + jnp.sin(phi)*m*a_m/(1-m**2)*jnp.sin(m*(phi-phi_m))
-        f_y = jnp.sin(phi)*a_m/(1-m**2) * jnp.cos(m*(phi-phi_m)) - jnp.cos(phi)*m*a_m/(1-m**2)*jnp.sin(m*(phi-phi_m))
+        r, cos_phi, sin_phi = self._polar_trig(x, y, center_x, center_y)
+        cos_m_phi, sin_m_phi = self._angular_terms(m, phi_m, cos_phi, sin_phi)
+        amp = a_m / (1 - m**2)
+        cos_term = amp * cos_m_phi
+        sin_term = m * amp * sin_m_phi
+        f_x = cos_phi * cos_term + sin_phi * sin_term
+        f_y = sin_phi * cos_term - cos_phi * sin_term
         return f_x, f_y
 
+    def function_and_derivatives(self, x, y, m, a_m, phi_m, center_x=0, center_y=0):
+        """
+        Lensing potential and deflection of a multipole contribution, 
+        sharing the polar coordinates and angular terms between the two.
+
+        :param m: int, multipole order, m>=2
+        :param a_m: float, multipole strength
+        :param phi_m: float, multipole orientation in radian
+        :param center_x: x-position
+        :param center_y: x-position
+        :return: lensing potential, deflection angles alpha_x, alpha_y
+        """
+        r, cos_phi, sin_phi = self._polar_trig(x, y, center_x, center_y)
+        cos_m_phi, sin_m_phi = self._angular_terms(m, phi_m, cos_phi, sin_phi)
+        amp = a_m / (1 - m**2)
+        cos_term = amp * cos_m_phi
+        sin_term = m * amp * sin_m_phi
+        f_ = r * cos_term
+        f_x = cos_phi * cos_term + sin_phi * sin_term
+        f_y = sin_phi * cos_term - cos_phi * sin_term
+        return f_, f_x, f_y
+
     def hessian(self, x, y, m, a_m, phi_m, center_x=0, center_y=0):
         """
         Hessian of a multipole contribution (for 1 component with m>=2)
@@ -74,9 +120,90 @@ class Multipole(object):
         :param center_y: x-position
         :return: f_xx, f_xy, f_yx, f_yy
         """
-        r, phi = param_util.cart2polar(x, y, center_x=center_x, center_y=center_y)
-        r = jnp.maximum(r, 0.000001)
-        f_xx = 1./r * jnp.sin(phi)**2 * a_m * jnp.cos(m*(phi-phi_m))
-        f_yy = 1./r * jnp.cos(phi)**2 * a_m * jnp.cos(m*(phi-phi_m))
-        f_xy = -1./r * a_m * jnp.cos(phi) * jnp.sin(phi) * jnp.cos(m*(phi-phi_m))
+        r, cos_phi, sin_phi = self._polar_trig(x, y, center_x, center_y)
+        cos_m_phi, _ = self._angular_terms(m, phi_m, cos_phi, sin_phi)
+        common = jnp.reciprocal(jnp.maximum(r, 0.000001)) * a_m * cos_m_phi
+        f_xx = sin_phi**2 * common
+        f_yy = cos_phi**2 * common
+        f_xy = -sin_phi * cos_phi * common
         return f_xx, f_xy, f_xy, f_yy
+
+    @partial(jit, static_argnums=(0, 3))
+    def function_parallel(self, x, y, m, a_m, phi_m, center_x=0, center_y=0):
+        """
+        Same as function(), jit-compiled for a fixed (integer) m and 
+        explicitly mapped over pixels (and devices if more than one is available).
+        """
+        return pixel_map(self.function, x, y, m, a_m, phi_m, center_x, center_y)
+
+    @partial(jit, static_argnums=(0, 3))
+    def derivatives_parallel(self, x, y, m, a_m, phi_m, center_x=0, center_y=0):
+        """
+        Same as derivatives(), jit-compiled for a fixed (integer) m and 
+        explicitly mapped over pixels (and devices if more than one is available).
+        """
+        return pixel_map(self.derivatives, x, y, m, a_m, phi_m, center_x, center_y)
+
+    @partial(jit, static_argnums=(0, 3))
+    def hessian_parallel(self, x, y, m, a_m, phi_m, center_x=0, center_y=0):
+        """
+        Same as hessian(), jit-compiled for a fixed (integer) m and 
+        explicitly mapped over pixels (and devices if more than one is available).
+        """
+        return pixel_map(self.hessian, x, y, m, a_m, phi_m, center_x, center_y)
+
+    @staticmethod
+    def _polar_trig(x, y, center_x, center_y):
+        """
+        Radius, cosine and sine of the polar angle, computed without evaluating the angle itself.
+        At the center, the angle is set to zero (same convention as arctan2).
+
+        :return: r, cos(phi), sin(phi)
+        """
+        dx = x - center_x
+        dy = y - center_y
+        r = jnp.hypot(dx, dy)
+        non_zero = r > 0
+        r_ = jnp.where(non_zero, r, 1.)  # avoids NaN in gradients at the center
+        cos_phi = jnp.where(non_zero, dx / r_, 1.)
+        sin_phi = jnp.where(non_zero, dy / r_, 0.)
+        return r, cos_phi, sin_phi
+
+    @staticmethod
+    def _static_order(m):
+        """
+        Returns m as a python integer if its value is known at trace time 
+        (i.e. it is not a traced value) and is a positive integer, None otherwise.
+        """
+        if isinstance(m, jax.core.Tracer) or np.ndim(m) != 0:
+            return None
+        m_value = float(m)
+        if not m_value.is_integer() or m_value < 1:
+            return None
+        return int(m_value)
+
+    @classmethod
+    def _angular_terms(cls, m, phi_m, cos_phi, sin_phi):
+        """
+        Computes cos(m*(phi-phi_m)) and sin(m*(phi-phi_m)) from cos(phi) and sin(phi).
+        If m is an integer known at trace time, cos(m*phi) and sin(m*phi) are obtained 
+        with Chebyshev polynomials (for m <= 6) or de Moivre's formula unrolled at trace time, 
+        such that no transcendental function needs to be evaluated per pixel.
+
+        :return: cos(m*(phi-phi_m)), sin(m*(phi-phi_m))
+        """
+        m_static = cls._static_order(m)
+        if m_static in _CHEBYSHEV_TU:
+            chebyshev_t, chebyshev_u = _CHEBYSHEV_TU[m_static]
+            cos_m, sin_m = chebyshev_t(cos_phi), sin_phi * chebyshev_u(cos_phi)
+        elif m_static is not None:
+            cos_m, sin_m = cos_phi, sin_phi
+            for _ in range(m_static - 1):
+                cos_m, sin_m = cos_m*cos_phi - sin_m*sin_phi, sin_m*cos_phi + cos_m*sin_phi
+        else:
+            phi = jnp.arctan2(sin_phi, cos_phi)
+            cos_m, sin_m = jnp.cos(m*phi), jnp.sin(m*phi)
+        cos_m_phi_m, sin_m_phi_m = jnp.cos(m*phi_m), jnp.sin(m*phi_m)
+        cos_m_phi = cos_m*cos_m_phi_m + sin_m*sin_m_phi_m
+        sin_m_phi = sin_m*cos_m_phi_m - cos_m*sin_m_phi_m
+        return cos_m_phi, sin_m_phi
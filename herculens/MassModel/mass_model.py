@@ -63,9 +63,11 @@ class MassModel(MassProfileBase):
         :return: fermat potential in arcsec**2 without geometry term (second part of Eqn 1 in Suyu et al. 2013) as a list
         """
 
-        potential = self.potential(x_image, y_image, kwargs_lens, k=k)
         if x_source is None or y_source is None:
-            x_source, y_source = self.ray_shooting(x_image, y_image, kwargs_lens, k=k)
+            potential, (dx, dy) = self.potential_and_alpha(x_image, y_image, kwargs_lens, k=k)
+            x_source, y_source = x_image - dx, y_image - dy
+        else:
+            potential = self.potential(x_image, y_image, kwargs_lens, k=k)
         geometry = ((x_image - x_source)**2 + (y_image - y_source)**2) / 2.
         return geometry - potential
 
@@ -116,6 +118,32 @@ class MassModel(MassProfileBase):
                 f_y += f_y_i
         return f_x, f_y
 
+    def potential_and_alpha(self, x, y, kwargs, k=None):
+        """
+        lensing potential and deflection angles at the same positions. Profiles that implement 
+        function_and_derivatives() compute both at once, sharing their intermediate quantities
+        :param x: x-position (preferentially arcsec)
+        :type x: numpy array
+        :param y: y-position (preferentially arcsec)
+        :type y: numpy array
+        :param kwargs: list of keyword arguments of lens model parameters matching the lens model classes
+        :param k: only evaluate the k-th lens model
+        :return: lensing potential in units of arcsec^2, deflection angles in units of arcsec
+        """
+        bool_list = self._bool_list(k)
+        potential, f_x, f_y = 0., 0., 0.
+        for i, func in enumerate(self.func_list):
+            if bool_list[i] is True:
+                if hasattr(func, 'function_and_derivatives'):
+                    potential_i, f_x_i, f_y_i = func.function_and_derivatives(x, y, **kwargs[i])
+                else:
+                    potential_i = func.function(x, y, **kwargs[i])
+                    f_x_i, f_y_i = func.derivatives(x, y, **kwargs[i])
+                potential += potential_i
+                f_x += f_x_i
+                f_y += f_y_i
+        return potential, (f_x, f_y)
+
     def hessian(self, x, y, kwargs, k=None):
         """
         hessian matrix
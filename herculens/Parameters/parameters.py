@@ -6,9 +6,10 @@ __author__ = 'aymgal'
 
 
 from copy import deepcopy
+from functools import cached_property
 import numpy as np
+import jax
 import jax.numpy as jnp
-from jax import lax
 
 from herculens.MassModel.Profiles import pixelated as pixelated_lens
 from herculens.MassModel.Profiles import (epl, sie, sis, nie, shear, point_mass, 
@@ -22,6 +23,54 @@ from herculens.LightModel.light_model_base import SUPPORTED_MODELS as LIGHT_MODE
 __all__ = ['Parameters']
 
 
+# LaTeX symbols of the (non-pixelated) parameters
+_LATEX_SYMBOLS = {
+    'pixels': r"{\rm pixels}",
+    'theta_E': r"$\theta_{\rm E}$",
+    'gamma': r"$\gamma'$",
+    'gamma_ext': r"$\gamma_{\rm ext}$",
+    'psi_ext': r"$\psi_{\rm ext}$",
+    'gamma1': r"$\gamma_{\rm 1, ext}$",
+    'gamma2': r"$\gamma_{\rm 2, ext}$",
+    'amp': r"$A$",
+    'R_sersic': r"$R_{\rm Sersic}$",
+    'n_sersic': r"$n_{\rm Sersic}$",
+    'e1': r"$e_1$",
+    'e2': r"$e_2$",
+    'center_x': r"$x_0$",
+    'center_y': r"$y_0$",
+    'ra_0': r"${\rm RA}_0$",
+    'dec_0': r"${\rm Dec}_0$",
+    'm': r"$m$",
+    'a_m': r"$a_m$",
+    'phi_m': r"$\phi_m$",
+    'psi': r"\psi",
+}
+
+# profile classes for each supported model, used to look up parameter names
+_LIGHT_PROFILE_CLASSES = {
+    'GAUSSIAN': gaussian.Gaussian,
+    'GAUSSIAN_ELLIPSE': gaussian.GaussianEllipse,
+    'SERSIC': sersic.Sersic,
+    'SERSIC_ELLIPSE': sersic.SersicElliptic,
+    'UNIFORM': uniform.Uniform,
+    'PIXELATED': pixelated_light.Pixelated,
+}
+_MASS_PROFILE_CLASSES = {
+    'GAUSSIAN': gaussian_potential.Gaussian,
+    'EPL': epl.EPL,
+    'SIE': sie.SIE,
+    'SIS': sis.SIS,
+    'NIE': nie.NIE,
+    'POINT_MASS': point_mass.PointMass,
+    'SHEAR': shear.Shear,
+    'SHEAR_GAMMA_PSI': shear.ShearGammaPsi,
+    'MULTIPOLE': multipole.Multipole,
+    'PIXELATED': pixelated_lens.PixelatedPotential,
+    'PIXELATED_DIRAC': pixelated_lens.PixelatedPotentialDirac,
+}
+
+
 class Parameters(object):
     """Class that manages parameters in JAX / auto-differentiable framework.
     Currently, it handles:
@@ -119,27 +168,22 @@ class Parameters(object):
             samples.append(param_values)
         return np.array(samples)
 
-    @property
+    @cached_property
     def names(self):
-        if not hasattr(self, '_names'):
-            self._names = self._set_names('mass_model_list', 'kwargs_lens')
-            self._names += self._set_names('source_model_list', 'kwargs_source')
-            self._names += self._set_names('lens_light_model_list', 'kwargs_lens_light')
-        return self._names
+        return (self._set_names('mass_model_list', 'kwargs_lens')
+                + self._set_names('source_model_list', 'kwargs_source')
+                + self._set_names('lens_light_model_list', 'kwargs_lens_light'))
 
-    @property
+    @cached_property
     def symbols(self):
-        if not hasattr(self, '_symbols'):
-            self._symbols = self._name2latex(self.names)
-        return self._symbols
+        return self._name2latex(self.names)
 
-    @property
+    @cached_property
     def kwargs_model(self):
         # TODO: intermediate step, this might be suppressed in the future
-        self._kwargs_model = dict(mass_model_list=self._image.MassModel.profile_type_list,
-                                  source_model_list=self._image.SourceModel.profile_type_list,
-                                  lens_light_model_list=self._image.LensLightModel.profile_type_list)
-        return self._kwargs_model
+        return dict(mass_model_list=self._image.MassModel.profile_type_list,
+                    source_model_list=self._image.SourceModel.profile_type_list,
+                    lens_light_model_list=self._image.LensLightModel.profile_type_list)
 
     def initial_values(self, as_kwargs=False, copy=False):
         if as_kwargs:
@@ -164,7 +208,7 @@ class Parameters(object):
         self._kwargs_map = self.args2kwargs(self._map_values)
     
     def set_posterior(self, samples):
-        self._map_values = np.median(samples, axis=0)
+        self._map_values = np.asarray(jnp.quantile(jnp.asarray(samples), 0.5, axis=0))
         self._kwargs_map = self.args2kwargs(self._map_values)
 
     def update_fixed(self, kwargs_fixed, kwargs_prior=None):
@@ -180,11 +224,18 @@ class Parameters(object):
         self._update_arrays()
 
     def args2kwargs(self, args):
-        i = 0
         args = jnp.atleast_1d(args)
-        kwargs_lens, i = self._get_params(args, i, 'mass_model_list', 'kwargs_lens')
-        kwargs_source, i = self._get_params(args, i, 'source_model_list', 'kwargs_source')
-        kwargs_lens_light, i = self._get_params(args, i, 'lens_light_model_list', 'kwargs_lens_light')
+        kwargs_lens = [{} for _ in self.kwargs_model['mass_model_list']]
+        kwargs_source = [{} for _ in self.kwargs_model['source_model_list']]
+        kwargs_lens_light = [{} for _ in self.kwargs_model['lens_light_model_list']]
+        kwargs_all = {'kwargs_lens': kwargs_lens, 'kwargs_source': kwargs_source, 'kwargs_lens_light': kwargs_lens_light}
+        for kwargs_key, k, name, offset, shape in self._slot_table:
+            if offset is None:
+                kwargs_all[kwargs_key][k][name] = self._kwargs_fixed[kwargs_key][k][name]
+            elif shape is None:
+                kwargs_all[kwargs_key][k][name] = args[offset]
+            else:
+                kwargs_all[kwargs_key][k][name] = args[offset:offset + shape[0] * shape[1]].reshape(shape)
         # apply joint param rules
         kwargs_lens = self._join_params(kwargs_lens, kwargs_lens, self._kwargs_joint['lens_with_lens'])
         kwargs_source = self._join_params(kwargs_source, kwargs_source, self._kwargs_joint['source_with_source'])
@@ -207,10 +258,25 @@ class Parameters(object):
         return kwargs_list_2
 
     def kwargs2args(self, kwargs):
-        args = self._set_params(kwargs, 'mass_model_list', 'kwargs_lens')
-        args += self._set_params(kwargs, 'source_model_list', 'kwargs_source')
-        args += self._set_params(kwargs, 'lens_light_model_list', 'kwargs_lens_light')
-        return jnp.array(args)
+        values = []
+        for kwargs_key, k, name, offset, shape in self._slot_table:
+            if offset is None:
+                continue
+            value = kwargs[kwargs_key][k][name]
+            if shape is not None:
+                if isinstance(value, (int, float)):
+                    value = value * np.ones(shape)
+                elif value.shape != shape:
+                    raise ValueError("Pixelated array is inconsistent with pixelated grid.")
+            values.append((offset, value))
+        # traced values (e.g. when differentiating through this method) cannot be written in a numpy buffer
+        if any(isinstance(value, jax.core.Tracer) for _, value in values):
+            return jnp.concatenate([jnp.ravel(value) for _, value in values])
+        args = np.empty(self._num_params, dtype=np.float64)
+        for offset, value in values:
+            value = np.ravel(value)
+            args[offset:offset + value.size] = value
+        return jnp.asarray(args)
 
     def kwargs2args_prior(self, kwargs_prior):
         types_m, lowers_m, uppers_m, means_m, widths_m = self._set_params_prior(kwargs_prior, 'mass_model_list', 'kwargs_lens')
@@ -224,30 +290,20 @@ class Parameters(object):
         return types, np.array(lowers), np.array(uppers), np.array(means), np.array(widths)
 
     def log_prior(self, args):
-        logP = 0
-        for i in range(self.num_parameters):
-            gaussian_prior = self._prior_types[i] == 'gaussian'
-            uniform_prior  = self._prior_types[i] == 'uniform'
-            logP += lax.cond(gaussian_prior, lambda _: - 0.5 * ((args[i] - self._means[i]) / self._widths[i]) ** 2, lambda _: 0., operand=None)
-            logP += lax.cond(uniform_prior, lambda _: lax.cond(args[i] < self._lowers[i], lambda _: - self._unif_prior_penalty, lambda _: 0., operand=None), lambda _: 0., operand=None)
-            logP += lax.cond(uniform_prior, lambda _: lax.cond(args[i] > self._uppers[i], lambda _: - self._unif_prior_penalty, lambda _: 0., operand=None), lambda _: 0., operand=None)
-        return logP
+        return self.log_prior_gaussian(args) + self._log_prior_uniform_penalty(args)
 
     def log_prior_gaussian(self, args):
-        logP = 0
-        for i in range(self.num_parameters):
-            gaussian_prior = self._prior_types[i] == 'gaussian'
-            logP += lax.cond(gaussian_prior, lambda _: - 0.5 * ((args[i] - self._means[i]) / self._widths[i]) ** 2, lambda _: 0., operand=None)
-        return logP
+        args_gaussian = args[self._gaussian_idx]
+        return - 0.5 * jnp.sum(((args_gaussian - self._gaussian_means) / self._gaussian_widths) ** 2)
 
     def log_prior_uniform(self, args):
-        logP = 0.
-        for i in range(self.num_parameters):
-            uniform_prior  = self._prior_types[i] == 'uniform'
-            # logP += lax.cond(uniform_prior, lambda _: lax.cond(args[i] < self._lowers[i], lambda _: - self._unif_prior_penalty, lambda _: 0., operand=None), lambda _: 0., operand=None)
-            # logP += lax.cond(uniform_prior, lambda _: lax.cond(args[i] > self._uppers[i], lambda _: - self._unif_prior_penalty, lambda _: 0., operand=None), lambda _: 0., operand=None)
-            logP += lax.cond(uniform_prior, lambda _: - (args[i] - jnp.clip(args[i], a_min=self._lowers[i], a_max=self._uppers[i]))**2, lambda _: 0., operand=None)
-        return logP
+        args_uniform = args[self._uniform_idx]
+        return - jnp.sum((args_uniform - jnp.clip(args_uniform, a_min=self._uniform_lowers, a_max=self._uniform_uppers))**2)
+
+    def _log_prior_uniform_penalty(self, args):
+        args_uniform = args[self._uniform_idx]
+        out_of_bounds = (args_uniform < self._uniform_lowers) | (args_uniform > self._uniform_uppers)
+        return - jnp.sum(jnp.where(out_of_bounds, self._unif_prior_penalty, 0.))
 
     def apply_bounds(self, args):
         return jnp.clip(args, a_min=self._lowers, a_max=self._uppers)
@@ -264,49 +320,16 @@ class Parameters(object):
     @staticmethod
     def get_class_for_model(kwargs_key, model):
         # TODO: move outside of this class
-        profile_class = None
         if kwargs_key in ['kwargs_source', 'kwargs_lens_light']:
             if model not in LIGHT_MODELS:
                 raise ValueError(f"'{model}' is not supported.")
-            if model == 'GAUSSIAN':
-                profile_class = gaussian.Gaussian
-            if model == 'GAUSSIAN_ELLIPSE':
-                profile_class = gaussian.GaussianEllipse
-            elif model == 'SERSIC':
-                profile_class = sersic.Sersic
-            elif model == 'SERSIC_ELLIPSE':
-                profile_class = sersic.SersicElliptic
-            elif model == 'CORE_SERSIC':
-                profile_class = sersic.CoreSersic
-            elif model == 'UNIFORM':
-                profile_class = uniform.Uniform
-            elif model == 'PIXELATED':
-                profile_class = pixelated_light.Pixelated
+            profile_class = _LIGHT_PROFILE_CLASSES.get(model, None)
         elif kwargs_key == 'kwargs_lens':
             if model not in MASS_MODELS:
-                raise ValueError("'{model}' is not supported.")
-            elif model == 'GAUSSIAN':
-                profile_class = gaussian_potential.Gaussian
-            elif model == 'EPL':
-                profile_class = epl.EPL
-            elif model == 'SIE':
-                profile_class = sie.SIE
-            elif model == 'SIS':
-                profile_class = sis.SIS
-            elif model == 'NIE':
-                profile_class = nie.NIE
-            elif model == 'POINT_MASS':
-                profile_class = point_mass.PointMass
-            elif model == 'SHEAR':
-                profile_class = shear.Shear
-            elif model == 'SHEAR_GAMMA_PSI':
-                profile_class = shear.ShearGammaPsi
-            elif model == 'MULTIPOLE':
-                profile_class = multipole.Multipole
-            elif model == 'PIXELATED':
-                profile_class = pixelated_lens.PixelatedPotential
-            elif model == 'PIXELATED_DIRAC':
-                profile_class = pixelated_lens.PixelatedPotentialDirac
+                raise ValueError(f"'{model}' is not supported.")
+            profile_class = _MASS_PROFILE_CLASSES.get(model, None)
+        else:
+            profile_class = None
         if profile_class is None:
             raise ValueError(f"Could not find the model class for '{model}'")
         return profile_class
@@ -317,17 +340,24 @@ class Parameters(object):
 
     def _update_arrays(self):
         self._kwargs_fixed = self._update_fixed_with_joint(self._kwargs_fixed, self._kwargs_joint)
+        self._slot_table, self._num_params = self._set_slot_table()
         self._prior_types, self._lowers, self._uppers, self._means, self._widths \
             = self.kwargs2args_prior(self._kwargs_prior)
+        # indices and prior settings of the parameters that have a prior, to evaluate log-priors only on those
+        gaussian_idx = np.array([i for i, t in enumerate(self._prior_types) if t == 'gaussian'], dtype=np.int32)
+        uniform_idx = np.array([i for i, t in enumerate(self._prior_types) if t == 'uniform'], dtype=np.int32)
+        self._gaussian_idx, self._uniform_idx = jnp.asarray(gaussian_idx), jnp.asarray(uniform_idx)
+        self._gaussian_means = jnp.asarray(self._means[gaussian_idx])
+        self._gaussian_widths = jnp.asarray(self._widths[gaussian_idx])
+        self._uniform_lowers = jnp.asarray(self._lowers[uniform_idx])
+        self._uniform_uppers = jnp.asarray(self._uppers[uniform_idx])
         self._init_values = self.kwargs2args(self._kwargs_init)
         self._kwargs_init = self.args2kwargs(self._init_values)  # for updating missing fields
-        self._num_params = len(self._init_values)
         if self.optimized:
             self._map_values = self.kwargs2args(self._kwargs_map)
-        if hasattr(self, '_names'):
-            delattr(self, '_names')
-        if hasattr(self, '_symbols'):
-            delattr(self, '_symbols')
+        # invalidate cached properties that depend on the fixed parameters
+        self.__dict__.pop('names', None)
+        self.__dict__.pop('symbols', None)
 
     def _update_fixed_with_joint(self, kwargs_fixed, kwargs_joint):
         kwargs_fixed = self._update_fixed_with_joint_one(kwargs_fixed, kwargs_joint, 'kwargs_lens', 'lens_with_lens')
@@ -350,56 +380,35 @@ class Parameters(object):
                 kwargs_fixed_updt[kwargs_key][k_2][param_name_2] = 0
         return kwargs_fixed_updt
 
-    def _get_params(self, args, i, kwargs_model_key, kwargs_key):
-        kwargs_list = []
-        for k, model in enumerate(self.kwargs_model[kwargs_model_key]):
-            kwargs = {}
-            kwargs_fixed_k = self._kwargs_fixed[kwargs_key][k]
-            param_names = self.get_param_names_for_model(kwargs_key, model)
-            for name in param_names:
-                if not name in kwargs_fixed_k:
-                    if model == 'PIXELATED':
-                        if kwargs_key == 'kwargs_lens':
-                            n_pix_x, n_pix_y = self._image.MassModel.pixelated_shape
-                        elif kwargs_key == 'kwargs_source':
-                            n_pix_x, n_pix_y = self._image.SourceModel.pixelated_shape
-                        elif kwargs_key == 'kwargs_lens_light':
-                            n_pix_x, n_pix_y = self._image.LensLightModel.pixelated_shape
-                        num_param = int(n_pix_x * n_pix_y)
-                        kwargs['pixels'] = args[i:i + num_param].reshape(n_pix_x, n_pix_y)
-                    else:
-                        num_param = 1
-                        kwargs[name] = args[i]
-                    i += num_param
-                else:
-                    kwargs[name] = kwargs_fixed_k[name]
-            kwargs_list.append(kwargs)
-        return kwargs_list, i
-
-    def _set_params(self, kwargs, kwargs_model_key, kwargs_key):
-        args = []
-        for k, model in enumerate(self.kwargs_model[kwargs_model_key]):
-            kwargs_profile = kwargs[kwargs_key][k]
-            kwargs_fixed_k = self._kwargs_fixed[kwargs_key][k]
-            param_names = self.get_param_names_for_model(kwargs_key, model)
-            for name in param_names:
-                if not name in kwargs_fixed_k:
-                    if model == 'PIXELATED':
-                        pixels = kwargs_profile['pixels']
-                        if kwargs_key == 'kwargs_lens':
-                            n_pix_x, n_pix_y = self._image.MassModel.pixelated_shape
-                        elif kwargs_key == 'kwargs_source':
-                            n_pix_x, n_pix_y = self._image.SourceModel.pixelated_shape
-                        elif kwargs_key == 'kwargs_lens_light':
-                            n_pix_x, n_pix_y = self._image.LensLightModel.pixelated_shape
-                        if isinstance(pixels, (int, float)):
-                            pixels = pixels * np.ones((n_pix_x, n_pix_y))
-                        elif pixels.shape != (n_pix_x, n_pix_y):
-                            raise ValueError("Pixelated array is inconsistent with pixelated grid.")
-                        args += pixels.flatten().tolist()
+    def _set_slot_table(self):
+        """Position of each parameter in the args array, as a list of 
+        (kwargs_key, profile index, parameter name, offset, pixelated shape or None),
+        along with the total number of free parameters. Fixed parameters have an offset None."""
+        slot_table = []
+        offset = 0
+        for kwargs_model_key, kwargs_key in [('mass_model_list', 'kwargs_lens'), 
+                                             ('source_model_list', 'kwargs_source'), 
+                                             ('lens_light_model_list', 'kwargs_lens_light')]:
+            for k, model in enumerate(self.kwargs_model[kwargs_model_key]):
+                kwargs_fixed_k = self._kwargs_fixed[kwargs_key][k]
+                param_names = self.get_param_names_for_model(kwargs_key, model)
+                for name in param_names:
+                    if not name in kwargs_fixed_k:
+                        if model == 'PIXELATED':
+                            if kwargs_key == 'kwargs_lens':
+                                n_pix_x, n_pix_y = self._image.MassModel.pixelated_shape
+                            elif kwargs_key == 'kwargs_source':
+                                n_pix_x, n_pix_y = self._image.SourceModel.pixelated_shape
+                            elif kwargs_key == 'kwargs_lens_light':
+                                n_pix_x, n_pix_y = self._image.LensLightModel.pixelated_shape
+                            slot_table.append((kwargs_key, k, 'pixels', offset, (n_pix_x, n_pix_y)))
+                            offset += int(n_pix_x * n_pix_y)
+                        else:
+                            slot_table.append((kwargs_key, k, name, offset, None))
+                            offset += 1
                     else:
-                        args.append(kwargs_profile[name])
-        return args
+                        slot_table.append((kwargs_key, k, name, None, None))
+        return slot_table, offset
 
     def _set_params_prior(self, kwargs, kwargs_model_key, kwargs_key):
         types, lowers, uppers, means, widths = [], [], [], [], []
@@ -506,62 +515,20 @@ class Parameters(object):
     def name2latex(name_raw):
         # TODO: move outside of this class
         name, model_type, profile_idx = name_raw.split('-')   # encapsulate this line in a well-named method
+        if name in _LATEX_SYMBOLS:
+            return _LATEX_SYMBOLS[name]
+        return Parameters._pixel_name2latex(name)
 
+    @staticmethod
+    def _pixel_name2latex(name):
         # pixelated models
-        if name[:2] == 'd_':  
-            latex = r"$d_{" + r"{}".format(int(name[2:])) + r"}$"
-        elif name[:2] == 's_':  
-            latex = r"$s_{" + r"{}".format(int(name[2:])) + r"}$"
-        elif name[:5] == 'dpsi_':  
-            latex = r"$\delta\psi_{" + r"{}".format(int(name[5:])) + r"}$"
-        elif name == 'pixels':
-            latex = r"{\rm pixels}"
-
-        # analytical models
-        elif name == 'theta_E':
-            latex = r"$\theta_{\rm E}$"
-        elif name == 'gamma':
-            latex = r"$\gamma'$"
-        elif name == 'gamma_ext':
-            latex = r"$\gamma_{\rm ext}$"
-        elif name == 'psi_ext':
-            latex = r"$\psi_{\rm ext}$"
-        elif name == 'gamma1':
-            latex = r"$\gamma_{\rm 1, ext}$"
-        elif name == 'gamma2':
-            latex = r"$\gamma_{\rm 2, ext}$"
-        elif name == 'amp':
-            latex = r"$A$"
-        elif name == 'R_sersic':
-            latex = r"$R_{\rm Sersic}$"
-        elif name == 'n_sersic':
-            latex = r"$n_{\rm Sersic}$"
-        elif name == 'e1':
-            latex = r"$e_1$"
-        elif name == 'e2':
-            latex = r"$e_2$"
-        elif name == 'center_x':
-            latex = r"$x_0$"
-        elif name == 'center_y':
-            latex = r"$y_0$"
-        elif name == 'ra_0':
-            latex = r"${\rm RA}_0$"
-        elif name == 'dec_0':
-            latex = r"${\rm Dec}_0$"
-        elif name == 'm':
-            latex = r"$m$"
-        elif name == 'a_m':
-            latex = r"$a_m$"
-        elif name == 'phi_m':
-            latex = r"$\phi_m$"
-        elif name == 'psi':
-            latex = r"\psi"
-        else:
-            raise ValueError("latex symbol for variable '{}' is unknown".format(name))
-        return latex
+        if name.startswith('d_'):
+            return r"$d_{" + r"{}".format(int(name[2:])) + r"}$"
+        elif name.startswith('s_'):
+            return r"$s_{" + r"{}".format(int(name[2:])) + r"}$"
+        elif name.startswith('dpsi_'):
+            return r"$\delta\psi_{" + r"{}".format(int(name[5:])) + r"}$"
+        raise ValueError("latex symbol for variable '{}' is unknown".format(name))
 
     def _name2latex(self, names):
-        latexs = []
-        for name in names:
-            latexs.append(self.name2latex(name))
-        return latexs
+        return [self.name2latex(name) for name in names]
@@ -8,8 +8,14 @@ __author__ = 'austinpeel', 'aymgal'
 from functools import partial
 from copy import deepcopy
 import numpy as np
+import jax
 import jax.numpy as jnp
 from jax import jit, vmap, lax
+from jax.sharding import Mesh, PartitionSpec
+try:
+    from jax import shard_map
+except ImportError:
+    from jax.experimental.shard_map import shard_map
 from jax.scipy.special import gammaln
 from jax.scipy.signal import convolve2d
 from jax.scipy.stats import norm
@@ -33,6 +39,41 @@ def unjaxify_kwargs(kwargs_params):
     return kwargs_params_new
 
 
+def pixel_map(func, x, y, *args):
+    """
+    Evaluates a pixel-wise function `func(x, y, *args)` by mapping it over 
+    the flattened coordinates. If more than one device is available 
+    (and the number of pixels is a multiple of the number of devices), 
+    pixels are split across devices.
+
+    Parameters
+    ----------
+    func : callable
+        Function of the coordinates (x, y) and additional parameters, 
+        with no dependency between pixels. It can return a single array or a tuple of arrays.
+    x, y : array_like
+        Coordinates, of any (same) shape.
+    args : 
+        Additional arguments passed to `func`, identical for all pixels.
+
+    Returns
+    -------
+    Output(s) of `func`, with the same shape as `x`.
+
+    """
+    shape = jnp.shape(x)
+    x_flat, y_flat = jnp.ravel(x), jnp.ravel(y)
+    func_pixels = vmap(lambda x_, y_: func(x_, y_, *args))
+    num_devices = jax.device_count()
+    if num_devices > 1 and x_flat.size % num_devices == 0:
+        mesh = Mesh(np.array(jax.devices()), ('pixels',))
+        func_pixels = shard_map(func_pixels, mesh=mesh, 
+                                in_specs=(PartitionSpec('pixels'), PartitionSpec('pixels')), 
+                                out_specs=PartitionSpec('pixels'))
+    result = func_pixels(x_flat, y_flat)
+    return jax.tree_util.tree_map(lambda r: r.reshape(shape), result)
+
+
 def R_omega(z, t, q, nmax):
     """Angular dependency of the deflection angle in the EPL lens profile.
 
@@ -103,7 +144,7 @@ class special(object):
 
 class GaussianFilter(object):
     """JAX-friendly Gaussian filter."""
-    def __init__(self, sigma, truncate=4.0):
+    def __init__(self, sigma, truncate=4.0, dtype=None):
         """Convolve an image by a gaussian filter.
 
         Parameters
@@ -113,26 +154,44 @@ class GaussianFilter(object):
         truncate : float, optional
             Truncate the filter at this many standard deviations.
             Default is 4.0.
+        dtype : jax.numpy dtype, optional
+            If not None (e.g. jnp.bfloat16), the image and kernels are cast 
+            to this lower precision type for the convolutions, 
+            which are accumulated in float32. Default is None (full precision).
 
         Note
         ----
         Reproduces `scipy.ndimage.gaussian_filter` with high accuracy.
+        The Gaussian kernel being separable, the filter is applied as two 
+        successive 1D convolutions (along each axis), which costs 2(2N+1) 
+        operations per pixel instead of (2N+1)^2 for a kernel of half-width N.
 
         """
-        self.kernel = self.gaussian_kernel(sigma, truncate)
+        kernel_1d = self.gaussian_kernel_1d(sigma, truncate)
+        self._dtype = dtype
+        if dtype is not None:
+            kernel_1d = kernel_1d.astype(dtype)
+        # store both 1D kernels such that they are not re-created at each call
+        self.kernel_x = kernel_1d[None, :]
+        self.kernel_y = kernel_1d[:, None]
+
+    @property
+    def kernel(self):
+        """Equivalent 2D kernel."""
+        return self.kernel_y * self.kernel_x
 
-    def gaussian_kernel(self, sigma, truncate):
+    def gaussian_kernel_1d(self, sigma, truncate):
         # Determine the kernel pixel size (rounded up to an odd int)
         self.radius = int(jnp.ceil(2 * truncate * sigma)) // 2
         npix = self.radius * 2 + 1  # always at least 1
 
         # Return the identity if sigma is not a positive number
         if sigma <= 0:
-            return jnp.array([[1.]])
+            return jnp.array([1.])
 
         # Compute the kernel
-        x, y = jnp.indices((npix, npix))  # pixel coordinates
-        kernel = norm.pdf(jnp.hypot(x - self.radius, y - self.radius) / sigma)
+        x = jnp.arange(npix)  # pixel coordinates
+        kernel = norm.pdf((x - self.radius) / sigma)
         kernel /= kernel.sum()
 
         return kernel
@@ -150,7 +209,22 @@ class GaussianFilter(object):
         # pad_mode = ['constant', 'edge'][mode == 'nearest']
         # image_padded = jnp.pad(image, pad_width=radius, mode=pad_mode)
         image_padded = jnp.pad(image, pad_width=self.radius, mode='edge')
-        return convolve2d(image_padded, self.kernel, mode='valid')
+        if self._dtype is None:
+            image_conv = convolve2d(image_padded, self.kernel_x, mode='valid')
+            return convolve2d(image_conv, self.kernel_y, mode='valid')
+        image_conv = self._convolve_low_precision(image_padded, self.kernel_x)
+        image_conv = self._convolve_low_precision(image_conv, self.kernel_y)
+        return image_conv.astype(image.dtype)
+
+    def _convolve_low_precision(self, image, kernel):
+        """'valid' convolution in reduced precision, with float32 accumulation."""
+        # the kernel is symmetric, so no need to flip it for the cross-correlation
+        image_conv = conv_general_dilated(image.astype(self._dtype)[None, None, :, :], 
+                                          kernel[None, None, :, :], 
+                                          window_strides=(1, 1), padding='VALID', 
+                                          precision=lax.Precision.HIGHEST,
+                                          preferred_element_type=jnp.float32)
+        return image_conv[0, 0]
 
 
 class WaveletTransform(object):
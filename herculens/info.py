@@ -14,7 +14,7 @@ __email__ = 'austin.peel@epfl.ch'
 __year__ = '2021'
 __url__ = 'https://github.com/austinpeel/jax-strong-lensing'
 __description__ = 'JAX-enabled autodifferentiable strong lens modelling'
-__python__ = '>=3.7'
+__python__ = '>=3.8'
 __requires__ = ['numpy', 'scipy', 'jax', 'jaxlib', 'findiff']  # Package dependencies
 
 # Default package properties